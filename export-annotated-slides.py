@@ -3,11 +3,16 @@
 import xmltodict
 import json
 import re
+import math
 import glob
 import os
 import subprocess
+import argparse
 
 # throw into raw recording directory next to events.xml and run, should generate out/*.pdf
+parser = argparse.ArgumentParser()
+parser.add_argument("--simplify", type=float, default=0, help="simplify pencil strokes with a tolerance of N pixels at 1920x1080, 0 disables")
+args = parser.parse_args()
 
 recording = xmltodict.parse(open("events.xml").read())['recording']
 
@@ -48,25 +53,75 @@ for event in recording['event']:
 def get_datapoints(event):
     return list([(float(x)/100, float(y)/100) for x, y in re.findall(r'([^,]+),([^,]+)', event['dataPoints'])])
 
-def annot_pencil(event):
+# Ramer-Douglas-Peucker, iterative so long strokes don't hit the recursion limit
+def simplify(points, tolerance):
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        norm = math.hypot(dx, dy)
+        maxdist, index = 0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if norm:
+                dist = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                dist = math.hypot(x - x1, y - y1)
+            if dist > maxdist:
+                maxdist, index = dist, i
+        if maxdist > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+# shapeId -> (points before, points after simplification)
+pointstats = {}
+
+def annot_pencil(event, tolerance=0):
     svg = '<path stroke="#%06x" fill="none" stroke-linejoin="round" stroke-linecap="round" stroke-width="%.2f" d="' % (int(event['color']), (float(event['thickness'])/100*width))
-    datapoints = get_datapoints(event)
+    datapoints = [(x*width, y*height) for x, y in get_datapoints(event)]
+    ops = []
     for c in event['commands'].split(","):
         if c == "1":
-            x, y = datapoints.pop(0)
-            svg += 'M%s, %s ' % (x*width, y*height)
+            ops.append(('M', [datapoints.pop(0)]))
         elif c == "2":
-            x, y = datapoints.pop(0)
-            svg += 'L%s, %s ' % (x*width, y*height)
+            ops.append(('L', [datapoints.pop(0)]))
         elif c == "3":
-            x1, y1 = datapoints.pop(0)
-            x2, y2 = datapoints.pop(0)
-            svg += 'Q%s, %s, %s, %s ' % (x1*width, y1*height, x2*width, y2*height)
+            ops.append(('Q', [datapoints.pop(0) for i in range(2)]))
         elif c == "4":
-            x1, y1 = datapoints.pop(0)
-            x2, y2 = datapoints.pop(0)
-            x3, y3 = datapoints.pop(0)
-            svg += 'C%s, %s, %s, %s, %s, %s ' % (x1*width, y1*height, x2*width, y2*height, x3*width, y3*height)
+            ops.append(('C', [datapoints.pop(0) for i in range(3)]))
+
+    # only straight line runs get simplified, curve control points are kept as they are
+    before = after = 0
+    i = 0
+    while i < len(ops):
+        letter, points = ops[i]
+        if letter != 'L':
+            svg += '%s%s ' % (letter, ', '.join('%s, %s' % point for point in points))
+            before += len(points)
+            after += len(points)
+            i += 1
+            continue
+        j = i
+        while j < len(ops) and ops[j][0] == 'L':
+            j += 1
+        run = [point for op in ops[i:j] for point in op[1]]
+        anchor = ops[i-1][1][-1:] if i else []
+        simplified = simplify(anchor + run, tolerance)[len(anchor):]
+        for x, y in simplified:
+            svg += 'L%s, %s ' % (x, y)
+        before += len(run)
+        after += len(simplified)
+        i = j
+    # lines go through here as well, only count real pencil strokes
+    if event['type'] == "pencil":
+        pointstats[event['shapeId']] = (before, after)
     svg += '"/>'
     return svg
 
@@ -142,7 +197,7 @@ def process(origsvg, drawing):
     origsvg = origsvg.replace("</svg>", "")
     for shapeid, event in drawing.items():
         if event["type"] == "pencil":
-            origsvg += annot_pencil(event)
+            origsvg += annot_pencil(event, tolerance=args.simplify)
         elif event["type"] == "line":
             origsvg += annot_line(event)
         elif event["type"] == "ellipse":
@@ -176,3 +231,5 @@ for presdir in glob.glob("presentation/*"):
     if os.path.exists("out/%s.pdf" % presid):
         os.unlink("out/%s.pdf" % presid)
     subprocess.call(["pdfjoin", "-o", "out/%s.pdf" % presid] + list(["out/" + presid + "/slide%d.pdf" % page for page in range(1, num_pages+1)]))
+
+print("Pencil strokes: %d points, %d after simplification" % (sum(before for before, after in pointstats.values()), sum(after for before, after in pointstats.values())))
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+
+# poll a spool directory of raw recordings and run kdenlive-export.py on every finished one,
+# unknown arguments (e.g. --format ffv1 --jobs 4) are passed on to kdenlive-export.py
+parser = argparse.ArgumentParser()
+parser.add_argument("spool", help="directory containing raw recording directories")
+parser.add_argument("--workers", type=int, default=2, help="number of exports running at the same time")
+parser.add_argument("--cache", help="rendered frame cache shared between exports, defaults to <spool>/.cache")
+parser.add_argument("--cache-size", type=float, default=20, help="GB the frame cache may use for frames no kept recording links to, least recently used frames are removed first")
+parser.add_argument("--status", help="status file with queue depth and per job throughput, defaults to <spool>/status.json")
+parser.add_argument("--keep-jobs", type=float, default=86400, help="seconds finished jobs stay in the status file, failed recordings are retried after that")
+parser.add_argument("--settle", type=float, default=60, help="seconds events.xml has to stay unchanged before a recording counts as finished")
+parser.add_argument("--poll", type=float, default=10, help="seconds between spool scans")
+args, exportargs = parser.parse_known_args()
+
+# runs as a service with stdout going to a pipe or the journal, log lines should show up right away
+sys.stdout.reconfigure(line_buffering=True)
+
+spool = os.path.abspath(args.spool)
+cache = os.path.abspath(args.cache or os.path.join(spool, ".cache"))
+statusfile = os.path.abspath(args.status or os.path.join(spool, "status.json"))
+exporter = os.path.join(os.path.dirname(os.path.abspath(__file__)), "kdenlive-export.py")
+
+pending = deque()
+running = {}
+jobs = {}
+
+# seconds until events.xml of a new recording has settled, None if there is nothing to export
+def settling(name):
+    recording = os.path.join(spool, name)
+    events = os.path.join(recording, "events.xml")
+    if name.startswith('.') or name in jobs or not os.path.isfile(events):
+        return None
+    # already exported by an earlier run
+    if os.path.exists(os.path.join(recording, "%s.kdenlive" % name)):
+        return None
+    # the recording may be removed while we look at it
+    try:
+        return max(0, args.settle - (time.time() - os.path.getmtime(events)))
+    except OSError:
+        return None
+
+# kdenlive-export.py bumps the mtime of every cached frame it uses, so the oldest mtimes go first.
+# Frames still hardlinked from a recording take no space of their own, deleting them would free
+# nothing, so only frames the cache holds alone count towards --cache-size and get evicted.
+def trim_cache():
+    entries = []
+    for name in os.listdir(cache) if os.path.isdir(cache) else []:
+        if name.endswith(".share"):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache, name))
+        except OSError:
+            continue
+        if stat.st_nlink == 1:
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(cache, name)))
+    total = sum(size for mtime, size, path in entries)
+    limit = args.cache_size * 1024**3
+    for mtime, size, path in sorted(entries):
+        if total <= limit:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        total -= size
+
+def start(name):
+    recording = os.path.join(spool, name)
+    print("Exporting %s" % name)
+    jobs[name]['started'] = time.time()
+    try:
+        log = open(os.path.join(recording, "kdenlive-export.log"), "a")
+    except OSError as e:
+        print("Cannot export %s: %s" % (name, e))
+        finish(name, 1)
+        return
+    # --resume picks up where an interrupted daemon left off
+    running[name] = subprocess.Popen([sys.executable, exporter, recording, "--resume", "--cache", cache] + exportargs, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    jobs[name]['state'] = 'running'
+
+def finish(name, returncode):
+    job = jobs[name]
+    job['finished'] = time.time()
+    job['state'] = 'done' if returncode == 0 else 'failed'
+    print("Export of %s %s after %.1fs" % (name, job['state'], job['finished'] - job['started']))
+    manifestfile = os.path.join(spool, name, "frames/manifest.json")
+    if os.path.exists(manifestfile):
+        manifest = json.loads(open(manifestfile).read())
+        job['frames'] = len(manifest['frames'])
+        job['frames_per_second'] = job['frames'] / max(job['finished'] - job['started'], 0.001)
+
+# dropping a failed job also makes its recording eligible for another try
+def expire_jobs():
+    for name, job in list(jobs.items()):
+        if job['state'] in ('done', 'failed') and time.time() - job['finished'] > args.keep_jobs:
+            del jobs[name]
+
+def write_status():
+    status = {
+        'updated': time.time(),
+        'workers': args.workers,
+        'queued': len(pending),
+        'running': len(running),
+        'jobs': jobs,
+    }
+    open(statusfile + ".tmp", "w").write(json.dumps(status, indent=1))
+    os.replace(statusfile + ".tmp", statusfile)
+
+trim_cache()
+
+# everything is decided by the settle time and exiting exports, neither of which a file
+# system watch would report, so the spool is polled and the wait is cut short when a
+# recording is about to settle
+while True:
+    wait = args.poll
+    for name in sorted(os.listdir(spool)):
+        remaining = settling(name)
+        if remaining is None:
+            continue
+        if remaining == 0:
+            print("Queueing %s" % name)
+            jobs[name] = {'state': 'queued', 'queued': time.time()}
+            pending.append(name)
+        else:
+            wait = min(wait, remaining)
+
+    for name, proc in list(running.items()):
+        if proc.poll() is not None:
+            del running[name]
+            finish(name, proc.returncode)
+            trim_cache()
+
+    while pending and len(running) < args.workers:
+        start(pending.popleft())
+
+    expire_jobs()
+    write_status()
+
+    # a finished export frees its slot right away instead of at the next scan
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        if any(proc.poll() is not None for proc in running.values()):
+            break
+        time.sleep(max(0, min(0.2, deadline - time.time()) if running else deadline - time.time()))
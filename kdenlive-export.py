@@ -3,42 +3,96 @@
 import xmltodict
 import json
 import re
+import math
 import glob
 import os
 import subprocess
 import sys
+import argparse
+import hashlib
+import shutil
 import svgutils
 
 def get_datapoints(event):
     return list([(float(x)/100, float(y)/100) for x, y in re.findall(r'([^,]+),([^,]+)', event['dataPoints'])])
 
-def annot_pencil(event, res):
+# Ramer-Douglas-Peucker, iterative so long strokes don't hit the recursion limit
+def simplify(points, tolerance):
+    if tolerance <= 0 or len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        (x1, y1), (x2, y2) = points[first], points[last]
+        dx, dy = x2 - x1, y2 - y1
+        norm = math.hypot(dx, dy)
+        maxdist, index = 0, None
+        for i in range(first + 1, last):
+            x, y = points[i]
+            if norm:
+                dist = abs(dy * (x - x1) - dx * (y - y1)) / norm
+            else:
+                dist = math.hypot(x - x1, y - y1)
+            if dist > maxdist:
+                maxdist, index = dist, i
+        if maxdist > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+# shapeId -> (points before, points after simplification)
+pointstats = {}
+
+def annot_pencil(event, res, tolerance=0):
     width,height = res
     svg = '<path stroke="#%06x" fill="none" stroke-linejoin="round" stroke-linecap="round" stroke-width="%.2f" d="' % (int(event['color']), (float(event['thickness'])/100*width))
-    datapoints = get_datapoints(event)
+    datapoints = [(x*width, y*height) for x, y in get_datapoints(event)]
+    ops = []
     for c in event['commands'].split(","):
         if c == "1":
-            x, y = datapoints.pop(0)
-            svg += 'M%s, %s ' % (x*width, y*height)
+            ops.append(('M', [datapoints.pop(0)]))
         elif c == "2":
-            x, y = datapoints.pop(0)
-            svg += 'L%s, %s ' % (x*width, y*height)
+            ops.append(('L', [datapoints.pop(0)]))
         elif c == "3":
-            x1, y1 = datapoints.pop(0)
-            x2, y2 = datapoints.pop(0)
-            svg += 'Q%s, %s, %s, %s ' % (x1*width, y1*height, x2*width, y2*height)
+            ops.append(('Q', [datapoints.pop(0) for i in range(2)]))
         elif c == "4":
-            x1, y1 = datapoints.pop(0)
-            x2, y2 = datapoints.pop(0)
-            x3, y3 = datapoints.pop(0)
-            svg += 'C%s, %s, %s, %s, %s, %s ' % (x1*width, y1*height, x2*width, y2*height, x3*width, y3*height)
+            ops.append(('C', [datapoints.pop(0) for i in range(3)]))
+
+    # only straight line runs get simplified, curve control points are kept as they are
+    before = after = 0
+    i = 0
+    while i < len(ops):
+        letter, points = ops[i]
+        if letter != 'L':
+            svg += '%s%s ' % (letter, ', '.join('%s, %s' % point for point in points))
+            before += len(points)
+            after += len(points)
+            i += 1
+            continue
+        j = i
+        while j < len(ops) and ops[j][0] == 'L':
+            j += 1
+        run = [point for op in ops[i:j] for point in op[1]]
+        anchor = ops[i-1][1][-1:] if i else []
+        simplified = simplify(anchor + run, tolerance)[len(anchor):]
+        for x, y in simplified:
+            svg += 'L%s, %s ' % (x, y)
+        before += len(run)
+        after += len(simplified)
+        i = j
+    # lines go through here as well, only count real pencil strokes
+    if event['type'] == "pencil":
+        pointstats[event['shapeId']] = (before, after)
     svg += '"/>'
     return svg
 
 def annot_line(event, res):
     width,height = res
     event["commands"] = "1,2"
-    return annot_pencil(event)
+    return annot_pencil(event, res)
 
 def annot_ellipse(event, res):
     width,height = res
@@ -105,13 +159,56 @@ def annot_text(event, res):
     return svg
 
 
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected a number, got %s" % value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % value)
+    return number
+
+def shard_spec(value):
+    try:
+        shard, shards = [int(x) for x in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected i/N, e.g. 0/4")
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError("shard %s out of range, shards are numbered 0 to N-1" % value)
+    return shard, shards
+
 # throw into raw recording directory next to events.xml and run, should generate out/*.pdf
-path = sys.argv[1]
+parser = argparse.ArgumentParser()
+parser.add_argument("path", help="raw recording directory containing events.xml")
+parser.add_argument("--resume", action="store_true", help="continue from last checkpoint in frames/ and reuse rendered frames")
+parser.add_argument("--checkpoint-interval", type=positive_int, default=50, help="write a checkpoint every N frames")
+# without any of these all phases run in one go
+phases = parser.add_mutually_exclusive_group()
+phases.add_argument("--plan", action="store_true", help="only replay events and write frames/manifest.json with the frame svgs to render")
+phases.add_argument("--shard", type=shard_spec, help="only render shard i/N of the frames in frames/manifest.json, shards are numbered 0 to N-1")
+phases.add_argument("--assemble", action="store_true", help="write the .kdenlive file from frames/manifest.json once all shards are rendered")
+phases.add_argument("--jobs", type=positive_int, default=1, help="render locally with N shard processes")
+parser.add_argument("--format", choices=["png", "webp", "ffv1", "mjpeg"], default="png", help="frame images as png or lossless webp, or pack all frames into one ffv1/mjpeg video")
+parser.add_argument("--png-compression", type=int, choices=range(10), help="png compression level of the frames, trades file size only: ffmpeg re-encodes the png rendered by rsvg-convert, which costs more cpu than the plain path")
+parser.add_argument("--palette", action="store_true", help="quantize png frames to a 256 color palette")
+parser.add_argument("--simplify", type=float, default=0, help="simplify pencil strokes with a tolerance of N output pixels, 0 disables")
+parser.add_argument("--cache", help="directory of rendered frames shared between exports, e.g. for reused slide decks (never cleaned up here, kdenlive-daemon.py trims it)")
+args = parser.parse_args()
+# webp frames and frames packed into a video never end up as the png these settings are for
+if args.format != "png" and (args.png_compression is not None or args.palette):
+    parser.error("--png-compression and --palette only apply to --format png")
+
+script = os.path.abspath(__file__)
+cachedir = os.path.abspath(args.cache) if args.cache else None
+encoding = {'format': args.format, 'compression': args.png_compression, 'palette': args.palette}
+# part of every image name, so --resume never picks up frames made with other encoding settings
+encodingtag = hashlib.sha1(json.dumps(encoding, sort_keys=True).encode()).hexdigest()[:8]
+path = args.path
 os.chdir(path)
 if not os.path.exists("frames"):
     os.mkdir("frames")
-
-recording = xmltodict.parse(open("events.xml").read())['recording']
+if cachedir:
+    os.makedirs(cachedir, exist_ok=True)
 
 IGNORE_EVENTS = [
     'WhiteboardCursorMoveEvent',
@@ -143,27 +240,34 @@ IGNORE_EVENTS = [
 
 presentations = {}
 
+# what a damaged event or shape raises, empty elements like <whiteboardId/> come out of xmltodict as None
+DAMAGED = (KeyError, IndexError, ValueError, TypeError, AttributeError)
+
 def render(slide):
     width = float(slide['origsvg'].split('width="')[1].split('"')[0].replace('pt', ''))
     height = float(slide['origsvg'].split('height="')[1].split('"')[0].replace('pt', ''))
 
     svg = slide['origsvg'].replace('</svg>', '')
 
+    # a damaged shape is left out, the rest of the slide still renders
     for shapeid, event in slide['drawings'].items():
-        if event["type"] == "pencil":
-            svg += annot_pencil(event, res=(width,height))
-        elif event["type"] == "line":
-            svg += annot_line(event, res=(width,height))
-        elif event["type"] == "ellipse":
-            svg += annot_ellipse(event, res=(width,height))
-        elif event["type"] == "rectangle":
-            svg += annot_rectangle(event, res=(width,height))
-        elif event["type"] == "triangle":
-            svg += annot_triangle(event, res=(width,height))
-        elif event["type"] == "text":
-            svg += annot_text(event, res=(width,height))
-        else:
-            print("Unknown annotation type: %s" % event["type"])
+        try:
+            if event["type"] == "pencil":
+                svg += annot_pencil(event, res=(width,height), tolerance=args.simplify*height/1080)
+            elif event["type"] == "line":
+                svg += annot_line(event, res=(width,height))
+            elif event["type"] == "ellipse":
+                svg += annot_ellipse(event, res=(width,height))
+            elif event["type"] == "rectangle":
+                svg += annot_rectangle(event, res=(width,height))
+            elif event["type"] == "triangle":
+                svg += annot_triangle(event, res=(width,height))
+            elif event["type"] == "text":
+                svg += annot_text(event, res=(width,height))
+            else:
+                print("Unknown annotation type: %s" % event["type"])
+        except DAMAGED as e:
+            print("Skipping damaged shape %s: %r" % (shapeid, e))
 
     svg += '</svg>'
     return svg
@@ -172,146 +276,412 @@ curpresentation = None
 curslide = None
 sessionstart = 0
 sessionend = 0
-frame = 0
 melt = "melt"
 
+uniqueframes = {}
+
 frames = []
 audiotracks = []
 deskshares = {}
 webcams = {}
 users = {}
 
-for event in recording['event']:
-    drawframe = False
-
-    if event["@eventname"] in IGNORE_EVENTS:
-        continue
-
-    # session starteda
-    if event["@eventname"] == "CreatePresentationPodEvent":
-        sessionstart = int(event['timestampUTC']) / 1000
-    timestamp = int(event["timestampUTC"])/1000 - sessionstart
-
-    # user joined
-    if event["@eventname"] == "ParticipantJoinEvent":
-        users[event['userId']] = event['name']
-        continue
-
-    # start audio recording
-    if event["@eventname"] == "StartRecordingEvent":
-        if audiotracks:
-            audiotracks[-1]['length'] = timestamp - audiotracks[-1]['time']
-        audiotracks.append({'opus': "audio/%s" % event['filename'].split('/')[-1], 'time': timestamp})
-        continue
-
-    # start desktop recording
-    if event["@eventname"] == "StartWebRTCDesktopShareEvent":
-        print("Starting Desktop share")
-        filename = event['filename'].split('/')[-1]
-        deskshares[filename] = {'time': timestamp, 'webm': 'deskshare/%s' % filename}
-        continue
-
-    # stop desktop recording
-    if event["@eventname"] == "StopWebRTCDesktopShareEvent":
-        print("Stopping Desktop share")
-        filename = event['filename'].split('/')[-1]
-        deskshares[filename]['length'] = timestamp - deskshares[filename]['time']
-        continue
-
-    # start webcam recording
-    if event["@eventname"] == "StartWebRTCShareEvent":
-        filename = event['filename'].split('/')[-1]
-        dirname = event['filename'].split('/')[-2]
-        userid = filename.split('-')[1]
-        print("Starting Webcam share for %s" % users[userid])
-        webcams[filename] = {'time': timestamp, 'nick': users[userid], 'webm': 'video/%s/%s' % (dirname, filename)}
-        continue
-
-    # stop desktop recording
-    if event["@eventname"] == "StopWebRTCShareEvent":
-        filename = event['filename'].split('/')[-1]
-        print("Stopping Webcam share for %s" % webcams[filename]['nick'])
-        webcams[filename]['length'] = timestamp - webcams[filename]['time']
-        continue
-
-    # presentation switched (could be new or old)
-    if event["@eventname"] == "SharePresentationEvent":
-        print("Changing presentation to %s" % event["presentationName"])
-        drawframe = True
-        curpresentation = event["presentationName"]
-        curslide = 0
-
-        if curpresentation not in presentations:
-            presentations[curpresentation] = {}
-            presentations[curpresentation]['slides'] = []
-            for svgslide in sorted(glob.glob("presentation/%s/svgs/slide*.svg" % curpresentation), key=lambda x: int(x.split('/')[-1].lstrip('slide').rstrip('.svg'))):
-                slide = {}
-                print("Loading svg %s" % svgslide)
-                slide['origsvg'] = open(svgslide, 'r').read()
-                slide['drawings'] = {}
-                presentations[curpresentation]['slides'].append(slide)
-
-    # change slide
-    elif event["@eventname"] == "GotoSlideEvent":
-        print("Changing to slide %s" % event['slide'])
-        drawframe = True
-        curpresentation = event["presentationName"]
-        curslide = int(event['slide'])
-
-    # add shape to slide
-    elif event["@eventname"] == "AddShapeEvent":
-        print("Adding shape")
-        drawframe = True
-        presentation, slidestr = event["whiteboardId"].split('/')
-        slide = int(slidestr) - 1
-        if event["status"] == "DRAW_END":
-            presentations[presentation]['slides'][slide]['drawings'][event["shapeId"]] = event
+CHECKPOINT = "frames/checkpoint.json"
+FRAMELOG = "frames/frames.log"
+MANIFEST = "frames/manifest.json"
+
+def load_presentation(name):
+    presentations[name] = {}
+    presentations[name]['slides'] = []
+    for svgslide in sorted(glob.glob("presentation/%s/svgs/slide*.svg" % name), key=lambda x: int(x.split('/')[-1].lstrip('slide').rstrip('.svg'))):
+        slide = {}
+        print("Loading svg %s" % svgslide)
+        slide['origsvg'] = open(svgslide, 'r').read()
+        slide['drawings'] = {}
+        presentations[name]['slides'].append(slide)
+
+# raises before any state is changed, so a damaged event can't leave an invalid current slide behind
+def get_slide(presentation, slide):
+    slides = presentations[presentation]['slides']
+    if not 0 <= slide < len(slides):
+        raise IndexError("slide %d of %s out of range" % (slide, presentation))
+    return slides[slide]
+
+# identical slide states share one frame, the unique ones are numbered in order of appearance
+def add_frame(timestamp, key):
+    if key not in uniqueframes:
+        index = len(uniqueframes)
+        uniqueframes[key] = {'svg': "frames/%d.svg" % index, 'image': "frames/%d.%s.%s" % (index, encodingtag, "webp" if args.format == "webp" else "png")}
+    if frames:
+        frames[-1]['length'] = timestamp - frames[-1]['time']
+    frames.append({'image': uniqueframes[key]['image'], 'time': timestamp})
+    return uniqueframes[key]
+
+# Frames are appended to frames/frames.log as they come and live shapes are stored as offsets
+# into events.xml, so a checkpoint stays small no matter how long the recording is.
+# Slide svgs get reloaded from presentation/ on resume.
+def save_checkpoint(offset):
+    framelog.flush()
+    state = {
+        'offset': offset,
+        'curpresentation': curpresentation,
+        'curslide': curslide,
+        'sessionstart': sessionstart,
+        'sessionend': sessionend,
+        'encoding': encoding,
+        'simplify': args.simplify,
+        'frames': len(frames),
+        'pointstats': pointstats,
+        'audiotracks': audiotracks,
+        'deskshares': deskshares,
+        'webcams': webcams,
+        'users': users,
+        'drawings': {name: [[eventoffsets[id(event)] for event in slide['drawings'].values()] for slide in presentation['slides']] for name, presentation in presentations.items()},
+    }
+    open(CHECKPOINT + ".tmp", "w").write(json.dumps(state, separators=(',', ':')))
+    os.replace(CHECKPOINT + ".tmp", CHECKPOINT)
+
+# plain pngs come straight from rsvg-convert, everything else is re-encoded by ffmpeg
+def encode_frame(svgfile, imagefile, encoding):
+    base, ext = os.path.splitext(imagefile)
+    tmpfile = base + ".tmp" + ext
+    failed = None
+    if ext == ".png" and encoding['compression'] is None and not encoding['palette']:
+        if subprocess.call(["rsvg-convert", "-f", "png", svgfile, "-h", "1080", "-o", tmpfile]) != 0:
+            failed = "rsvg-convert failed to render %s" % svgfile
+    else:
+        cmd = ["ffmpeg", "-v", "error", "-y", "-f", "png_pipe", "-i", "-"]
+        if encoding['palette']:
+            cmd += ["-vf", "split[a][b];[a]palettegen=max_colors=256[p];[b][p]paletteuse=dither=none"]
+        if ext == ".webp":
+            cmd += ["-c:v", "libwebp", "-lossless", "1"]
         else:
+            cmd += ["-c:v", "png"]
+            if encoding['compression'] is not None:
+                cmd += ["-compression_level", str(encoding['compression'])]
+        cmd += ["-frames:v", "1", "-update", "1", tmpfile]
+        rsvg = subprocess.Popen(["rsvg-convert", "-f", "png", svgfile, "-h", "1080"], stdout=subprocess.PIPE)
+        ffmpeg = subprocess.call(cmd, stdin=rsvg.stdout)
+        rsvg.stdout.close()
+        # ffmpeg fails too when rsvg-convert gives it nothing, rsvg-convert is the one to blame then
+        if rsvg.wait() != 0:
+            failed = "rsvg-convert failed to render %s" % svgfile
+        elif ffmpeg != 0:
+            failed = "ffmpeg failed to encode %s into %s" % (svgfile, imagefile)
+    if failed:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+        sys.exit(failed)
+    os.replace(tmpfile, imagefile)
+
+# hardlink if possible, frames are never modified in place so sharing the inode is fine
+# several exports may share the same file at once, so every writer gets its own temp name
+def share_file(src, dst):
+    tmpfile = "%s.%d.%s.share" % (dst, os.getpid(), os.urandom(4).hex())
+    try:
+        try:
+            os.link(src, tmpfile)
+        except OSError:
+            shutil.copyfile(src, tmpfile)
+        os.replace(tmpfile, dst)
+    finally:
+        if os.path.exists(tmpfile):
+            os.unlink(tmpfile)
+
+def render_shard(shard, shards):
+    manifest = json.loads(open(MANIFEST).read())
+    for entry in manifest['frames'][shard::shards]:
+        if args.resume and os.path.exists(entry['image']):
+            print("Reusing frame %s" % entry['image'])
             continue
-
-    # delete shape from slide
-    elif event["@eventname"] == "UndoAnnotationEvent":
-        print("Removing shape")
-        drawframe = True
-        presentation, slidestr = event["whiteboardId"].split('/')
-        slide = int(slidestr) - 1
-        del presentations[presentation]['slides'][slide]['drawings'][event['shapeId']]
-
-    elif event["@eventname"] == "EndAndKickAllEvent":
-        sessionend = timestamp
-
-    # unknown event
+        if cachedir:
+            key = hashlib.sha1(open(entry['svg'], 'rb').read() + json.dumps(manifest['encoding'], sort_keys=True).encode()).hexdigest()
+            cached = os.path.join(cachedir, key + os.path.splitext(entry['image'])[1])
+            # the mtime marks the last use, kdenlive-daemon.py evicts the least recently used frames
+            try:
+                os.utime(cached)
+                share_file(cached, entry['image'])
+                print("Using cached frame %s" % entry['image'])
+                continue
+            except OSError:
+                pass
+        encode_frame(entry['svg'], entry['image'], manifest['encoding'])
+        # another export may have put the same frame there already, which is just as good
+        if cachedir and not os.path.exists(cached):
+            share_file(entry['image'], cached)
+
+# all frames as one lossless (ffv1) or mjpeg stream, each image shown for its frame length
+def pack_frames(frames, encoding):
+    concat = "ffconcat version 1.0\n"
+    for frame in frames:
+        concat += "file '%s'\nduration %.3f\n" % (os.path.basename(frame['image']), frame['length'])
+    # the concat demuxer ignores the duration of the last entry unless it is repeated
+    concat += "file '%s'\n" % os.path.basename(frames[-1]['image'])
+    open("frames/slides.ffconcat", "w").write(concat)
+    if encoding['format'] == "ffv1":
+        codec = ["-c:v", "ffv1", "-level", "3"]
     else:
-        pass
-        #print("Unknown event: %s" % event["@eventname"])
-        #print(json.dumps(event))
-
-    # render slide
-    if drawframe:
-        svg = render(presentations[curpresentation]['slides'][curslide])
-        open("frames/%d.svg" % frame, "w").write(svg)
-        subprocess.call(["rsvg-convert", "-f", "png", "frames/%d.svg" % frame, "-h", "1080", "-o", "frames/%d.png" % frame])
-        if frames:
-            frames[-1]['length'] = timestamp - frames[-1]['time']
-        frames.append({'png': 'frames/%d.png' % frame, 'time': timestamp})
-        frame += 1
-
-if frames:
-    frames[-1]['length'] = sessionend - frames[-1]['time']
-
-if audiotracks:
-    audiotracks[-1]['length'] = sessionend - audiotracks[-1]['time']
-
-webcams = list(webcams.values())
-deskshares = list(deskshares.values())
-
-for webcam in webcams:
-    if 'length' not in webcam:
-        webcam['length'] = sessionend - webcam['time']
+        codec = ["-c:v", "mjpeg", "-q:v", "1"]
+    # decks differ in aspect ratio, every frame has to end up as 1920x1080 like the project profile
+    scale = "scale=1920:1080:force_original_aspect_ratio=decrease,pad=1920:1080:(ow-iw)/2:(oh-ih)/2,setsar=1"
+    if subprocess.call(["ffmpeg", "-v", "error", "-y", "-f", "concat", "-i", "frames/slides.ffconcat", "-vf", scale, "-r", "25"] + codec + ["frames/slides.tmp.mkv"]) != 0:
+        sys.exit("Packing frames into frames/slides.mkv failed")
+    os.replace("frames/slides.tmp.mkv", "frames/slides.mkv")
+    # the video replaces the frame images, assembling again needs the frames rendered again
+    for image in set(frame['image'] for frame in frames):
+        os.unlink(image)
+    return "frames/slides.mkv"
+
+if not (args.shard or args.assemble):
+    recording = xmltodict.parse(open("events.xml").read())['recording']
+    eventoffsets = {id(event): offset for offset, event in enumerate(recording['event'])}
+
+    resume_offset = 0
+    state = None
+    if args.resume and os.path.exists(CHECKPOINT):
+        state = json.loads(open(CHECKPOINT).read())
+        # the frame image names in the checkpoint belong to the encoding they were planned with
+        if state.get('encoding') != encoding:
+            print("Encoding changed since the checkpoint, replaying from the start")
+            state = None
+        # the frame svgs in the checkpoint were drawn with that tolerance
+        elif state.get('simplify') != args.simplify:
+            print("Stroke simplification changed since the checkpoint, replaying from the start")
+            state = None
+    loggedframes = []
+    if state:
+        resume_offset = state['offset']
+        curpresentation = state['curpresentation']
+        curslide = state['curslide']
+        sessionstart = state['sessionstart']
+        sessionend = state['sessionend']
+        pointstats.update(state['pointstats'])
+        audiotracks = state['audiotracks']
+        deskshares = state['deskshares']
+        webcams = state['webcams']
+        users = state['users']
+        for name, drawings in state['drawings'].items():
+            load_presentation(name)
+            for slide, offsets in zip(presentations[name]['slides'], drawings):
+                slide['drawings'] = {recording['event'][offset]['shapeId']: recording['event'][offset] for offset in offsets}
+        # frames logged after the checkpoint get planned again
+        loggedframes = open(FRAMELOG).read().splitlines()[:state['frames']]
+        for line in loggedframes:
+            add_frame(*json.loads(line))
+        print("Resuming at event %d with %d frames" % (resume_offset, len(frames)))
+
+    framelog = open(FRAMELOG, "w")
+    for line in loggedframes:
+        framelog.write(line + "\n")
+
+    for offset, event in enumerate(recording['event']):
+        if offset < resume_offset:
+            continue
 
-for deskshare in deskshares:
-    if 'length' not in deskshare:
-        deskshare['length'] = sessionend - deskshare['time']
+        try:
+            drawframe = False
+
+            if event["@eventname"] in IGNORE_EVENTS:
+                continue
+
+            # session starteda
+            if event["@eventname"] == "CreatePresentationPodEvent":
+                sessionstart = int(event['timestampUTC']) / 1000
+            timestamp = int(event["timestampUTC"])/1000 - sessionstart
+
+            # user joined
+            if event["@eventname"] == "ParticipantJoinEvent":
+                users[event['userId']] = event['name']
+                continue
+
+            # start audio recording
+            if event["@eventname"] == "StartRecordingEvent":
+                if audiotracks:
+                    audiotracks[-1]['length'] = timestamp - audiotracks[-1]['time']
+                audiotracks.append({'opus': "audio/%s" % event['filename'].split('/')[-1], 'time': timestamp})
+                continue
+
+            # start desktop recording
+            if event["@eventname"] == "StartWebRTCDesktopShareEvent":
+                print("Starting Desktop share")
+                filename = event['filename'].split('/')[-1]
+                deskshares[filename] = {'time': timestamp, 'webm': 'deskshare/%s' % filename}
+                continue
+
+            # stop desktop recording
+            if event["@eventname"] == "StopWebRTCDesktopShareEvent":
+                print("Stopping Desktop share")
+                filename = event['filename'].split('/')[-1]
+                deskshares[filename]['length'] = timestamp - deskshares[filename]['time']
+                continue
+
+            # start webcam recording
+            if event["@eventname"] == "StartWebRTCShareEvent":
+                filename = event['filename'].split('/')[-1]
+                dirname = event['filename'].split('/')[-2]
+                userid = filename.split('-')[1]
+                nick = users.get(userid, userid)
+                print("Starting Webcam share for %s" % nick)
+                webcams[filename] = {'time': timestamp, 'nick': nick, 'webm': 'video/%s/%s' % (dirname, filename)}
+                continue
+
+            # stop desktop recording
+            if event["@eventname"] == "StopWebRTCShareEvent":
+                filename = event['filename'].split('/')[-1]
+                print("Stopping Webcam share for %s" % webcams[filename]['nick'])
+                webcams[filename]['length'] = timestamp - webcams[filename]['time']
+                continue
+
+            # presentation switched (could be new or old)
+            if event["@eventname"] == "SharePresentationEvent":
+                print("Changing presentation to %s" % event["presentationName"])
+                drawframe = True
+                if event["presentationName"] not in presentations:
+                    load_presentation(event["presentationName"])
+                get_slide(event["presentationName"], 0)
+                curpresentation = event["presentationName"]
+                curslide = 0
+
+            # change slide
+            elif event["@eventname"] == "GotoSlideEvent":
+                print("Changing to slide %s" % event['slide'])
+                drawframe = True
+                get_slide(event["presentationName"], int(event['slide']))
+                curpresentation = event["presentationName"]
+                curslide = int(event['slide'])
+
+            # add shape to slide
+            elif event["@eventname"] == "AddShapeEvent":
+                print("Adding shape")
+                drawframe = True
+                presentation, slidestr = event["whiteboardId"].split('/')
+                slide = int(slidestr) - 1
+                if event["status"] == "DRAW_END":
+                    get_slide(presentation, slide)['drawings'][event["shapeId"]] = event
+                else:
+                    continue
+
+            # delete shape from slide
+            elif event["@eventname"] == "UndoAnnotationEvent":
+                print("Removing shape")
+                drawframe = True
+                presentation, slidestr = event["whiteboardId"].split('/')
+                slide = int(slidestr) - 1
+                if get_slide(presentation, slide)['drawings'].pop(event['shapeId'], None) is None:
+                    print("Skipping undo of unknown shape %s" % event['shapeId'])
+
+            elif event["@eventname"] == "EndAndKickAllEvent":
+                sessionend = timestamp
+
+            # unknown event
+            else:
+                pass
+                #print("Unknown event: %s" % event["@eventname"])
+                #print(json.dumps(event))
+
+            # render slide
+            if drawframe:
+                svg = render(presentations[curpresentation]['slides'][curslide])
+                key = hashlib.sha1(svg.encode()).hexdigest()
+                new = key not in uniqueframes
+                entry = add_frame(timestamp, key)
+                framelog.write(json.dumps([timestamp, key]) + "\n")
+                if new:
+                    if not os.path.exists(entry['svg']) or open(entry['svg']).read() != svg:
+                        open(entry['svg'], "w").write(svg)
+                        if os.path.exists(entry['image']):
+                            os.unlink(entry['image'])
+                    # images of this frame made with other encoding settings
+                    for stale in glob.glob("frames/%d.*.*" % (len(uniqueframes) - 1)):
+                        if stale != entry['image']:
+                            os.unlink(stale)
+
+                if len(frames) % args.checkpoint_interval == 0:
+                    save_checkpoint(offset + 1)
+
+        # damaged event (unknown shape, unknown user, ...), keep going
+        except DAMAGED as e:
+            print("Skipping damaged %s at offset %d: %r" % (event.get("@eventname"), offset, e))
+
+    save_checkpoint(len(recording['event']))
+    framelog.close()
+
+    if frames:
+        frames[-1]['length'] = sessionend - frames[-1]['time']
+
+    if audiotracks:
+        audiotracks[-1]['length'] = sessionend - audiotracks[-1]['time']
+
+    webcams = list(webcams.values())
+    deskshares = list(deskshares.values())
+
+    for webcam in webcams:
+        if 'length' not in webcam:
+            webcam['length'] = sessionend - webcam['time']
+
+    for deskshare in deskshares:
+        if 'length' not in deskshare:
+            deskshare['length'] = sessionend - deskshare['time']
+
+    manifest = {
+        'encoding': encoding,
+        'frames': list(uniqueframes.values()),
+        'timeline': {
+            'sessionstart': sessionstart,
+            'sessionend': sessionend,
+            'frames': frames,
+            'audiotracks': audiotracks,
+            'webcams': webcams,
+            'deskshares': deskshares,
+        },
+    }
+    open(MANIFEST + ".tmp", "w").write(json.dumps(manifest, indent=1))
+    os.replace(MANIFEST + ".tmp", MANIFEST)
+    print("Planned %d frames, %d unique" % (len(frames), len(manifest['frames'])))
+    print("Pencil strokes: %d points, %d after simplification" % (sum(before for before, after in pointstats.values()), sum(after for before, after in pointstats.values())))
+
+    if args.plan:
+        sys.exit(0)
+
+# render phase, shards can run on different machines sharing the recording directory
+if (args.shard or args.assemble) and not os.path.exists(MANIFEST):
+    sys.exit("No %s yet, run with --plan first" % MANIFEST)
+
+if args.shard:
+    shard, shards = args.shard
+    render_shard(shard, shards)
+    sys.exit(0)
+
+if not args.assemble:
+    if args.jobs > 1:
+        # local stand-in for running the shards on several machines
+        extra = ["--resume"] if args.resume else []
+        if cachedir:
+            extra += ["--cache", cachedir]
+        workers = [subprocess.Popen([sys.executable, script, ".", "--shard", "%d/%d" % (i, args.jobs)] + extra) for i in range(args.jobs)]
+        if any(worker.wait() != 0 for worker in workers):
+            sys.exit("Rendering shards failed")
+    else:
+        render_shard(0, 1)
+
+# assemble phase
+manifest = json.loads(open(MANIFEST).read())
+missing = [entry['image'] for entry in manifest['frames'] if not os.path.exists(entry['image'])]
+if missing:
+    sys.exit("%d frames not rendered (or already packed into a video), e.g. %s" % (len(missing), missing[0]))
+
+sessionstart = manifest['timeline']['sessionstart']
+sessionend = manifest['timeline']['sessionend']
+frames = manifest['timeline']['frames']
+audiotracks = manifest['timeline']['audiotracks']
+webcams = manifest['timeline']['webcams']
+deskshares = manifest['timeline']['deskshares']
+
+frameservice = "qimage"
+if manifest['encoding']['format'] in ("ffv1", "mjpeg") and frames:
+    video = pack_frames(frames, manifest['encoding'])
+    frames = [{'image': video, 'time': frames[0]['time'], 'length': sum(frame['length'] for frame in frames)}]
+    frameservice = "avformat"
 
 kdenlive = """<?xml version='1.0' encoding='utf-8'?>
 <mlt LC_NUMERIC="C" producer="main_bin" version="6.22.1" root="{os.getcwd()}">
@@ -328,14 +698,14 @@ for i, frame in enumerate(frames):
         <producer id="frame{i}" in="00:00:00.000" out="{formattime(frame['length'])}">
             <property name="length">{formattime(frame['length'])}</property>
             <property name="eof">pause</property>
-            <property name="resource">{frame['png']}</property>
+            <property name="resource">{frame['image']}</property>
             <property name="ttl">25</property>
             <property name="aspect_ratio">1</property>
             <property name="progressive">1</property>
             <property name="seekable">1</property>
             <property name="meta.media.width">1920</property>
             <property name="meta.media.height">1080</property>
-            <property name="mlt_service">qimage</property>
+            <property name="mlt_service">{frameservice}</property>
             <property name="global_feed">1</property>
         </producer>
         """
@@ -593,4 +963,7 @@ kdenlive += f"""
 kdenlive += "</mlt>"
 
 
-open("%s.kdenlive" % os.path.basename(path), "w").write(kdenlive)
+# kdenlive-daemon.py takes an existing project as a finished export, so it must never be half written
+project = "%s.kdenlive" % os.path.basename(path)
+open(project + ".tmp", "w").write(kdenlive)
+os.replace(project + ".tmp", project)